@@ -4,9 +4,13 @@ from typing import Dict, List, Optional, Any
 from dataclasses import dataclass
 from elasticsearch import Elasticsearch
 import openai
+import time
 from datetime import datetime
+from functools import partial
 
 from util import s3_to_url;
+from scheduler import LLMScheduler, Priority, estimate_tokens
+from slow_query_log import SlowQueryLog
 
 @dataclass
 class SearchFeatures:
@@ -30,12 +34,28 @@ class SearchFeatures:
             self.description_keywords = []
 
 class ProductSearchSystem:
-    def __init__(self, es_client: Elasticsearch, openai_api_key: str, index_name: str = "products"):
+    def __init__(self, es_client: Elasticsearch, openai_api_key: str, index_name: str = "products",
+                 scheduler: Optional[LLMScheduler] = None, slow_query_log: Optional[SlowQueryLog] = None):
         self.es = es_client
         self.index_name = index_name
+        self.scheduler = scheduler or LLMScheduler()
+        self.slow_query_log = slow_query_log
         openai.api_key = openai_api_key
-        
-    def enhance_query(self, user_query: str) -> str:
+        # The scheduler owns backoff: client retries would spend RPM/TPM the buckets never
+        # charge and delay 429s reaching it
+        openai.max_retries = 0
+
+    def _chat_completion(self, priority: Priority = Priority.INTERACTIVE, **kwargs):
+        """Run a chat completion through the rate-limit aware scheduler"""
+        # An admitted call may take at most one more latency budget of its priority class
+        kwargs.setdefault("timeout", self.scheduler.latency_budgets[priority])
+        return self.scheduler.submit(
+            partial(openai.chat.completions.create, **kwargs),
+            estimate_tokens(kwargs["messages"], kwargs.get("max_tokens", 0)),
+            priority
+        )
+        
+    def enhance_query(self, user_query: str, priority: Priority = Priority.INTERACTIVE) -> str:
         """Enhance user query using LLM"""
 
         prompt = f"""
@@ -71,7 +91,8 @@ class ProductSearchSystem:
                 """;
 
         try:
-            response = openai.chat.completions.create(
+            response = self._chat_completion(
+                priority,
                 model="gpt-4",
                 messages=[
                     {"role": "system", "content": "You enhance user product queries for better understanding."},
@@ -88,8 +109,9 @@ class ProductSearchSystem:
 
         return user_query;
 
-    def extract_features_with_llm(self, user_query: str) -> SearchFeatures:
-        """Extract search features from user query using LLM"""
+    def extract_features_with_llm(self, user_query: str, priority: Priority = Priority.INTERACTIVE,
+                                  allow_fallback: bool = True) -> SearchFeatures:
+        """Extract search features from user query using LLM - raises instead of falling back if not allow_fallback"""
         
 
         
@@ -126,7 +148,8 @@ class ProductSearchSystem:
         """;
 
         try:
-            response = openai.chat.completions.create(
+            response = self._chat_completion(
+                priority,
                 model="gpt-4",
                 messages=[
                     {"role": "system", "content": "You enhance user product queries for better understanding."},
@@ -140,6 +163,8 @@ class ProductSearchSystem:
 
         except Exception as e:
             print(f"Error extracting features: {e}")
+            if not allow_fallback:
+                raise
 
 
         prompt = f"""
@@ -217,7 +242,8 @@ class ProductSearchSystem:
         """
         
         try:
-            response = openai.chat.completions.create(
+            response = self._chat_completion(
+                priority,
                 model="gpt-4",
                 messages=[
                     {"role": "system", "content": "You are a product search feature extractor. Return only valid JSON."},
@@ -245,6 +271,8 @@ class ProductSearchSystem:
             
         except Exception as e:
             print(f"Error extracting features: {e}")
+            if not allow_fallback:
+                raise
             # Fallback to basic extraction
             return self._basic_feature_extraction(user_query)
     
@@ -493,23 +521,33 @@ class ProductSearchSystem:
         
         return query
     
-    def search_products(self, user_query: str, image_vector : List[float] | None) -> Dict[str, Any]:
-        """Main search function with fallback strategies - LIMITED TO TOP 2 RESULTS"""
+    def search_products(self, user_query: str, image_vector : List[float] | None,
+                        priority: Priority = Priority.INTERACTIVE, allow_fallback: bool = True) -> Dict[str, Any]:
+        """
+        Main search function with fallback strategies - LIMITED TO TOP 2 RESULTS
+
+        With allow_fallback=False any LLM or query fallback raises instead, so callers
+        that cache the result never store a degraded answer.
+        """
         try:
             # Extract features using LLM
-            features = self.extract_features_with_llm(user_query)
+            features = self.extract_features_with_llm(user_query, priority, allow_fallback)
 
             # Try advanced query first
             try:
                 if image_vector is None:
                     es_query = self.build_elasticsearch_query(features, user_query)
+                    strategy = "advanced"
                 else:
                     es_query = self.build_fuzzy_type_vector_query(features, user_query, image_vector)
-                response = self.es.search(index=self.index_name, body=es_query)
+                    strategy = "vector"
+                response = self._timed_search(es_query, features, user_query, strategy)
             except Exception as e:
+                if not allow_fallback:
+                    raise
                 # Fallback to simple query
                 es_query = self.build_simple_query(user_query, features)
-                response = self.es.search(index=self.index_name, body=es_query)
+                response = self._timed_search(es_query, features, user_query, "simple")
 
             return {
                 "extracted_features": features,
@@ -520,8 +558,25 @@ class ProductSearchSystem:
             }
         except Exception as e:
             print(e);
+            if not allow_fallback:
+                raise
+
+
+    def _timed_search(self, es_query: Dict[str, Any], features: SearchFeatures, user_query: str, strategy: str) -> Dict[str, Any]:
+        """Run a search, recording it in the slow-query log when one is configured"""
+        if self.slow_query_log is None:
+            return self.es.search(index=self.index_name, body=es_query)
+
+        profiled = self.slow_query_log.should_profile()
+        body = {**es_query, "profile": True} if profiled else es_query
+
+        start = time.perf_counter()
+        response = self.es.search(index=self.index_name, body=body)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        self.slow_query_log.record(features, user_query, es_query, response, elapsed_ms, strategy, profiled)
+        return response
 
-    
     def build_fuzzy_type_vector_query(self, image_type: str, image_vector: List[float]) -> Dict[str, Any]:
         """
         Fuzzy version: More flexible type matching + vector ranking
@@ -572,7 +627,8 @@ class ProductSearchSystem:
         return query
 
 
-    def format_results_with_llm(self, search_results: Dict[str, Any], user_query: str) -> str:
+    def format_results_with_llm(self, search_results: Dict[str, Any], user_query: str,
+                                priority: Priority = Priority.INTERACTIVE, allow_fallback: bool = True) -> str:
         """Format search results using LLM for better presentation - FOCUSED ON TOP 2 RESULTS"""
         
         if "error" in search_results:
@@ -630,7 +686,8 @@ class ProductSearchSystem:
                 """
         
         try:
-            response = openai.chat.completions.create(
+            response = self._chat_completion(
+                priority,
                 model="gpt-4",
                 messages=[
                     {"role": "system", "content": "You are a helpful shopping assistant. Format the TOP 2 product search results in an engaging, detailed way."},
@@ -643,5 +700,26 @@ class ProductSearchSystem:
             return response.choices[0].message.content
             
         except Exception as e:
+            if not allow_fallback:
+                raise
             # Fallback formatting
-            return self._basic_format_results(search_results, user_query)
\ No newline at end of file
+            return self._basic_format_results(search_results, user_query)
+
+    def _basic_format_results(self, search_results: Dict[str, Any], user_query: str) -> str:
+        """Fallback formatting without LLM - same JSON structure as the LLM formatter"""
+        products = []
+        for hit in search_results["results"][:2]:
+            source = hit["_source"]
+            products.append({
+                "name": source.get("name", ""),
+                "brand": source.get("brand", ""),
+                "description": source.get("description", ""),
+                "image_url": s3_to_url(source.get("image_url", "")),
+                "price": f"${source.get('price', 0)}",
+                "rating": str(source.get("rating", "N/A"))
+            })
+
+        return json.dumps({
+            "summary": f"Top {len(products)} matches for \"{user_query}\"",
+            "products": products
+        })
@@ -0,0 +1,127 @@
+import io
+import json
+from typing import BinaryIO, Tuple, Union
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+EXIF_ORIENTATION = 0x0112
+
+
+class UploadTooLargeError(Exception):
+    """Raised when a request body exceeds the configured size cap"""
+
+
+class InvalidImageError(Exception):
+    """Raised when an upload cannot be decoded as an image"""
+
+
+class BodySizeLimitMiddleware:
+    """
+    ASGI middleware enforcing a request body cap while the body is received.
+
+    Counts bytes as they arrive, so chunked uploads without Content-Length are
+    cut off at the limit instead of being spooled to disk at any size.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self._reject(send)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    raise UploadTooLargeError(f"Upload exceeds {self.max_bytes} bytes")
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            # Whatever the app answers after the cap was hit (e.g. a 400 for the
+            # broken form body) is replaced by the 413 below
+            if exceeded:
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+
+        if exceeded and not response_started:
+            await self._reject(send)
+
+    async def _reject(self, send) -> None:
+        body = json.dumps({"error": f"Upload exceeds {self.max_bytes} bytes"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def downscale_image(
+    source: BinaryIO,
+    max_side: int,
+    quality: int = 85,
+    max_pixels: int = 24_000_000
+) -> Tuple[Union[bytes, BinaryIO], str]:
+    """
+    Downscale an image so its longest side is at most `max_side` and re-encode as JPEG.
+
+    CPU bound - run it in a worker pool, not on the event loop. `source` is read
+    in place (e.g. the spooled upload file); when it is already a small, upright
+    RGB JPEG it is returned rewound instead of re-encoded. Images that would still
+    decode to more than `max_pixels` after JPEG draft scaling are rejected before
+    any pixel data is loaded.
+    Returns the image bytes or file object and its content type.
+    """
+    try:
+        source.seek(0)
+        image = Image.open(source)
+
+        # Already small enough, upright and in a format the vectorizer accepts as is
+        if (image.format == "JPEG" and image.mode == "RGB" and max(image.size) <= max_side
+                and image.getexif().get(EXIF_ORIENTATION, 1) == 1):
+            source.seek(0)
+            return source, "image/jpeg"
+
+        # JPEG can decode at 1/2, 1/4, 1/8 scale directly, far cheaper than a full decode
+        image.draft("RGB", (max_side, max_side))
+
+        # Pillow only warns (not raises) below twice MAX_IMAGE_PIXELS, so cap decode size here
+        width, height = image.size
+        if width * height > max_pixels:
+            raise InvalidImageError(f"Image of {width}x{height} pixels exceeds {max_pixels} pixels")
+
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as e:
+        raise InvalidImageError(str(e))
+
+    return output.getvalue(), "image/jpeg"
@@ -4,13 +4,19 @@ from fastapi import FastAPI, UploadFile, File, Form;
 from fastapi.middleware.cors import CORSMiddleware;
 
 import os;
+import asyncio;
 import requests;
+from concurrent.futures import ThreadPoolExecutor;
 from dotenv import load_dotenv;
 from functools import partial;
 
 from typing import Optional;
 
 from helper import ProductSearchSystem;
+from scheduler import LLMScheduler, Priority;
+from slow_query_log import SlowQueryLog;
+from materialized import RecommendationMaterializer;
+from image_processing import BodySizeLimitMiddleware, downscale_image, InvalidImageError;
 
 from elasticsearch import Elasticsearch
 
@@ -25,11 +31,38 @@ openai_api_key = os.getenv("OPENAI_API_KEY");
 
 image_vectorizer_api = os.getenv("IMAGE_VC_API");
 
+openai_rpm = int(os.getenv("OPENAI_RPM", "500"));
+openai_tpm = int(os.getenv("OPENAI_TPM", "40000"));
+openai_burst_s = float(os.getenv("OPENAI_BURST_S", "10"));
+llm_interactive_budget = float(os.getenv("LLM_INTERACTIVE_BUDGET_S", "10"));
+llm_batch_budget = float(os.getenv("LLM_BATCH_BUDGET_S", "120"));
+llm_batch_reserve = float(os.getenv("LLM_BATCH_RESERVE", "0.5"));
+
+max_upload_bytes = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)));
+image_vc_max_side = int(os.getenv("IMAGE_VC_MAX_SIDE", "512"));
+image_workers = int(os.getenv("IMAGE_WORKERS", "4"));
+image_max_pixels = int(os.getenv("IMAGE_MAX_PIXELS", "24000000"));
+
+slow_query_log_path = os.getenv("SLOW_QUERY_LOG_PATH");
+slow_query_threshold_ms = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "500"));
+slow_query_sample_rate = float(os.getenv("SLOW_QUERY_SAMPLE_RATE", "1.0"));
+slow_query_profile_rate = float(os.getenv("SLOW_QUERY_PROFILE_RATE", "0.0"));
+
+materialize_top_n = int(os.getenv("MATERIALIZE_TOP_N", "40"));
+materialize_refresh_s = float(os.getenv("MATERIALIZE_REFRESH_S", "600"));
+materialize_max_staleness_s = float(os.getenv("MATERIALIZE_MAX_STALENESS_S", "1800"));
+materialize_min_count = float(os.getenv("MATERIALIZE_MIN_COUNT", "3"));
+materialize_workers = int(os.getenv("MATERIALIZE_WORKERS", "4"));
+
 app = FastAPI(
     title="Product Recommendation Engine",
     description="User Prompt -> Product Recommendation"
 );
 
+# Cap request bodies as they are received; small allowance for the multipart framing and the q field.
+# Registered before CORS so CORS wraps it and its 413s still carry the CORS headers
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=max_upload_bytes + 64 * 1024);
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -38,45 +71,119 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Dedicated pool for image decode/resize so the event loop is never blocked
+image_pool = ThreadPoolExecutor(max_workers=image_workers, thread_name_prefix="image");
+
 es = Elasticsearch(
     elk_url,
     api_key=elk_api_key
 )
     
+# Shared LLM scheduler - keeps all GPT-4 calls within the RPM/TPM quota
+llm_scheduler = LLMScheduler(
+    requests_per_minute=openai_rpm,
+    tokens_per_minute=openai_tpm,
+    burst_seconds=openai_burst_s,
+    batch_reserve=llm_batch_reserve,
+    latency_budgets={
+        Priority.INTERACTIVE: llm_interactive_budget,
+        Priority.BATCH: llm_batch_budget
+    }
+);
+
+# Slow-query log is only enabled when a path is configured
+slow_query_log = SlowQueryLog(
+    path=slow_query_log_path,
+    threshold_ms=slow_query_threshold_ms,
+    sample_rate=slow_query_sample_rate,
+    profile_rate=slow_query_profile_rate
+) if slow_query_log_path else None;
+
 # Initialize search system
 search_system = ProductSearchSystem(
     es_client=es,
     openai_api_key=openai_api_key,
-    index_name=elk_index
+    index_name=elk_index,
+    scheduler=llm_scheduler,
+    slow_query_log=slow_query_log
 )
 
+# Precomputed responses for head queries, disabled with MATERIALIZE_TOP_N=0.
+# At ~4k estimated tokens per query (3 GPT-4 calls) the default 40 queries per
+# 600s refresh is ~16k TPM, inside the batch share of the default 40k TPM quota.
+# Cycle time matters too: each query is 3 sequential GPT-4 calls (~30-60s), so 40
+# queries over 4 workers take ~5-10 min, keeping entries well inside the 1800s
+# staleness bound. Check last_cycle_s on /metrics/materialized when resizing.
+materializer = RecommendationMaterializer(
+    search_system,
+    top_n=materialize_top_n,
+    refresh_interval=materialize_refresh_s,
+    max_staleness=materialize_max_staleness_s,
+    min_count=materialize_min_count,
+    workers=materialize_workers
+) if materialize_top_n > 0 else None;
+
+@app.on_event("startup")
+async def start_materializer():
+    if materializer:
+        materializer.start();
+
+@app.on_event("shutdown")
+async def stop_materializer():
+    if materializer:
+        materializer.stop();
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy"}
 
+@app.get("/metrics/llm")
+async def llm_metrics():
+    """LLM scheduler queue depth, wait times and quota state"""
+    return llm_scheduler.stats();
+
+@app.get("/metrics/materialized")
+async def materialized_metrics():
+    """Hit rate and refresh state of the materialized head-query responses"""
+    return materializer.stats() if materializer else {"enabled": False};
+
 @app.post("/analyze")
 async def analyze_prompt(
     file: Optional[UploadFile] = File(None),
     q : str = Form(...)
 ):
     imageVC = None;
+    has_image = bool(file and file.content_type.startswith('image'));
+
+    # Head queries are served straight from the materialized store
+    if materializer and not has_image:
+        materialized = materializer.lookup(q);
+        if materialized is not None:
+            return JSONResponse(content=materialized);
+
+    if has_image:
+        try:
+            loop = asyncio.get_running_loop();
+            content, content_type = await loop.run_in_executor(
+                image_pool, partial(downscale_image, file.file, image_vc_max_side, max_pixels=image_max_pixels)
+            );
+        except InvalidImageError as e:
+            return JSONResponse(status_code=400, content={"error": f"Invalid image: {e}"});
 
-    if file and file.content_type.startswith('image'):
-        content = await file.read();
         files = {
-            "file": (file.filename, content, file.content_type)
+            "file": (file.filename, content, content_type)
         };
 
-        res = requests.post(image_vectorizer_api, files=files);
+        res = await run_in_threadpool(partial(requests.post, image_vectorizer_api, files=files));
         response = res.json();
 
         q = response["classification"][0]['class'];
         imageVC = response["embedding"];
 
 
-    results = results = await run_in_threadpool(partial(search_system.search_products, q, imageVC));
-    formatted_results = await run_in_threadpool(partial(search_system.format_results_with_llm, results, q));
+    results = results = await run_in_threadpool(partial(search_system.search_products, q, imageVC, Priority.INTERACTIVE));
+    formatted_results = await run_in_threadpool(partial(search_system.format_results_with_llm, results, q, Priority.INTERACTIVE));
 
 
     return JSONResponse(
@@ -0,0 +1,225 @@
+import heapq
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from scheduler import Priority
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query so trivially different spellings share one entry"""
+    return re.sub(r"\s+", " ", query.strip().lower())
+
+
+class QueryFrequencyTracker:
+    """
+    Exponentially decayed query counts - decaying each refresh lets the head follow traffic.
+
+    `record` is O(1) since it runs on the event loop: the table may grow to twice
+    `max_tracked` between decays (new keys beyond that are ignored until then), and
+    `decay` trims it back to the `max_tracked` hottest keys in one batch.
+    """
+
+    def __init__(self, decay: float = 0.5, max_tracked: int = 10000):
+        self.decay_factor = decay
+        self.max_tracked = max_tracked
+        self._counts: Dict[str, float] = {}
+        self._raw: Dict[str, str] = {}  # most recent raw spelling per key
+        self._lock = threading.Lock()
+
+    def record(self, query: str) -> str:
+        key = normalize_query(query)
+        with self._lock:
+            if key not in self._counts and len(self._counts) >= 2 * self.max_tracked:
+                return key
+            self._counts[key] = self._counts.get(key, 0.0) + 1.0
+            self._raw[key] = query
+        return key
+
+    def top(self, n: int, min_count: float = 1.0) -> List[Tuple[str, str]]:
+        """Top-n (key, raw query) pairs by decayed count"""
+        with self._lock:
+            keys = sorted(self._counts, key=self._counts.get, reverse=True)[:n]
+            return [(k, self._raw[k]) for k in keys if self._counts[k] >= min_count]
+
+    def decay(self) -> None:
+        with self._lock:
+            if len(self._counts) > self.max_tracked:
+                keep = heapq.nlargest(self.max_tracked, self._counts, key=self._counts.get)
+                self._counts = {k: self._counts[k] for k in keep}
+                self._raw = {k: self._raw[k] for k in keep}
+            for key in list(self._counts):
+                self._counts[key] *= self.decay_factor
+                if self._counts[key] < 0.1:
+                    del self._counts[key]
+                    del self._raw[key]
+
+
+class MaterializedStore:
+    """In-memory store of precomputed /analyze responses keyed by normalized query"""
+
+    def __init__(self):
+        self._entries: Dict[str, Tuple[Any, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, max_staleness: float) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or time.time() - entry[1] > max_staleness:
+            return None
+        return entry[0]
+
+    def put(self, key: str, response: Any) -> None:
+        with self._lock:
+            self._entries[key] = (response, time.time())
+
+    def age(self, key: str) -> Optional[float]:
+        with self._lock:
+            entry = self._entries.get(key)
+        return None if entry is None else time.time() - entry[1]
+
+    def retain(self, keys: List[str]) -> None:
+        """Drop every entry not in `keys`"""
+        keep = set(keys)
+        with self._lock:
+            self._entries = {k: v for k, v in self._entries.items() if k in keep}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RecommendationMaterializer:
+    """
+    Background job precomputing the full formatted /analyze response for head queries.
+
+    Every `refresh_interval` seconds (fixed rate, not after each cycle) the top-N
+    queries by decayed frequency are (re)computed at batch priority on a pool of
+    `workers` threads, so they never compete with interactive LLM traffic. Entries
+    older than `max_staleness` are never served; an entry can age up to one interval
+    plus one cycle's duration, and a warning is printed when cycles run too long
+    for `max_staleness` to hold.
+    """
+
+    def __init__(
+        self,
+        search_system,
+        top_n: int = 40,
+        refresh_interval: float = 600.0,
+        max_staleness: float = 1800.0,
+        min_count: float = 3.0,
+        workers: int = 4
+    ):
+        if max_staleness <= refresh_interval:
+            print(f"MATERIALIZE max_staleness {max_staleness}s cannot be met with a {refresh_interval}s "
+                  f"refresh; clamping to {2 * refresh_interval}s")
+            max_staleness = 2 * refresh_interval
+
+        self.search_system = search_system
+        self.top_n = top_n
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self.min_count = min_count
+        self.workers = workers
+        self.tracker = QueryFrequencyTracker()
+        self.store = MaterializedStore()
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "hits": 0, "misses": 0, "refreshed": 0, "refresh_failures": 0,
+            "last_refresh": None, "last_cycle_s": None, "cycle_overruns": 0
+        }
+
+    def lookup(self, query: str) -> Optional[Any]:
+        """Count the query and return its materialized response if one is fresh"""
+        key = self.tracker.record(query)
+        response = self.store.get(key, self.max_staleness)
+        with self._stats_lock:
+            self._stats["hits" if response is not None else "misses"] += 1
+        return response
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="materializer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self) -> None:
+        next_run = time.monotonic() + self.refresh_interval
+        while not self._stop.wait(max(0.0, next_run - time.monotonic())):
+            try:
+                self.refresh_once()
+            except Exception as e:
+                print(f"Error refreshing materialized recommendations: {e}")
+
+            # Fixed rate: the next cycle starts one interval after this one started
+            next_run += self.refresh_interval
+            if next_run < time.monotonic():
+                with self._stats_lock:
+                    self._stats["cycle_overruns"] += 1
+                next_run = time.monotonic()
+
+    def refresh_once(self) -> None:
+        """Recompute stale or missing entries for the current head queries"""
+        started = time.monotonic()
+        head = self.tracker.top(self.top_n, self.min_count)
+        self.store.retain([key for key, _ in head])
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="materializer") as pool:
+            list(pool.map(lambda item: self._refresh_entry(*item), head))
+
+        self.tracker.decay()
+        duration = time.monotonic() - started
+        with self._stats_lock:
+            self._stats["last_refresh"] = time.time()
+            self._stats["last_cycle_s"] = round(duration, 2)
+
+        if self.refresh_interval + duration > self.max_staleness:
+            print(f"Materialized refresh took {duration:.0f}s; entries may exceed max_staleness "
+                  f"{self.max_staleness}s and fall back to the slow path - lower top_n or raise workers")
+
+    def _refresh_entry(self, key: str, query: str) -> None:
+        if self._stop.is_set():
+            return
+        # Entries written earlier in a long-running cycle are still fresh
+        age = self.store.age(key)
+        if age is not None and age < self.refresh_interval / 2:
+            return
+
+        response = self._compute(query)
+        with self._stats_lock:
+            self._stats["refresh_failures" if response is None else "refreshed"] += 1
+        if response is not None:
+            self.store.put(key, response)
+
+    def _compute(self, query: str) -> Optional[Any]:
+        """Full /analyze pipeline at batch priority; None if any step failed or would have fallen back"""
+        # Fallbacks raise here - a degraded answer must not be pinned for max_staleness
+        try:
+            results = self.search_system.search_products(query, None, Priority.BATCH, allow_fallback=False)
+            return self.search_system.format_results_with_llm(results, query, Priority.BATCH, allow_fallback=False)
+        except Exception as e:
+            print(f"Error materializing '{query}': {e}")
+            return None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        return {
+            **stats,
+            "entries": len(self.store),
+            "top_n": self.top_n,
+            "refresh_interval_s": self.refresh_interval,
+            "max_staleness_s": self.max_staleness,
+            "workers": self.workers,
+        }
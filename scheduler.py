@@ -0,0 +1,309 @@
+import heapq
+import itertools
+import re
+import threading
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import openai
+
+
+class Priority(IntEnum):
+    """Priority classes for LLM calls - lower value is served first"""
+    INTERACTIVE = 0  # /analyze traffic
+    BATCH = 1  # background / precompute work
+
+
+class LLMOverloadedError(Exception):
+    """Raised when a call is shed because it cannot start within its latency budget"""
+
+
+def estimate_tokens(messages: List[Dict[str, str]], max_tokens: int) -> int:
+    """Rough token estimate for a chat call (~4 chars per token plus the completion budget)"""
+    prompt_chars = sum(len(m.get("content") or "") for m in messages)
+    return prompt_chars // 4 + max_tokens
+
+
+class TokenBucket:
+    """Token bucket refilled continuously; not thread safe, guarded by the scheduler lock"""
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_second)
+            self._updated = now
+
+    def time_until(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available (0 if available now)"""
+        missing = amount - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.refill_per_second
+
+    def consume(self, amount: float) -> None:
+        # May go negative when reconciling actual usage; refill pays the debt back
+        self.tokens -= amount
+
+    def drain(self, now: float) -> None:
+        self.tokens = min(self.tokens, 0.0)
+        self._updated = now
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """Parse OpenAI reset durations like "1s", "6m0s" or "20ms" into seconds"""
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """How long OpenAI asked us to back off, from the 429 response headers"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+
+    # Fall back to the reset time of whichever quota is exhausted
+    waits = [
+        _parse_duration(headers.get(f"x-ratelimit-reset-{kind}", ""))
+        for kind in ("requests", "tokens")
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0"
+    ]
+    waits = [w for w in waits if w is not None]
+    return max(waits) if waits else None
+
+
+class _Ticket:
+    __slots__ = ("priority", "tokens", "enqueued_at", "deadline")
+
+    def __init__(self, priority: Priority, tokens: int, enqueued_at: float, deadline: float):
+        self.priority = priority
+        self.tokens = tokens
+        self.enqueued_at = enqueued_at
+        self.deadline = deadline
+
+
+class LLMScheduler:
+    """
+    Central scheduler for LLM calls.
+
+    Models the RPM and TPM quotas as two token buckets and admits queued calls
+    strictly by (priority, arrival). Buckets only hold `burst_seconds` of quota so
+    a full minute can't go out at once. Calls whose expected wait exceeds the
+    latency budget of their priority class are shed with LLMOverloadedError so
+    callers can take their fallback path immediately instead of hitting a 429.
+    If OpenAI still answers 429, the buckets are drained and admission pauses
+    for the advertised retry-after period.
+
+    BATCH calls are only admitted while both buckets stay above a `batch_reserve`
+    fraction of their capacity, so background work can never drain the quota that
+    interactive calls arriving next will need.
+    """
+
+    DEFAULT_LATENCY_BUDGETS = {
+        Priority.INTERACTIVE: 10.0,
+        Priority.BATCH: 120.0,
+    }
+    DEFAULT_RATE_LIMIT_PAUSE = 5.0
+
+    def __init__(
+        self,
+        requests_per_minute: int = 500,
+        tokens_per_minute: int = 40000,
+        latency_budgets: Optional[Dict[Priority, float]] = None,
+        burst_seconds: float = 10.0,
+        batch_reserve: float = 0.5,
+        wait_samples: int = 1000
+    ):
+        requests_per_second = requests_per_minute / 60.0
+        tokens_per_second = tokens_per_minute / 60.0
+        # At least one request must fit, however small the burst window
+        self._requests = TokenBucket(max(1.0, requests_per_second * burst_seconds), requests_per_second)
+        self._tokens = TokenBucket(tokens_per_second * burst_seconds, tokens_per_second)
+        self._paused_until = 0.0
+        self.batch_reserve = batch_reserve
+        self.latency_budgets = dict(self.DEFAULT_LATENCY_BUDGETS)
+        if latency_budgets:
+            self.latency_budgets.update(latency_budgets)
+
+        self._cond = threading.Condition()
+        self._queue = []  # heap of (priority, seq, ticket)
+        self._seq = itertools.count()
+
+        # Metrics
+        self._max_depth = 0
+        self._in_flight = 0
+        self._counters = {
+            p: {"submitted": 0, "completed": 0, "failed": 0, "shed": 0, "rate_limited": 0} for p in Priority
+        }
+        self._waits = {p: deque(maxlen=wait_samples) for p in Priority}
+
+    def submit(self, call: Callable[[], Any], estimated_tokens: int, priority: Priority = Priority.INTERACTIVE) -> Any:
+        """Block until quota allows, then run `call` and return its result"""
+        # A single call larger than the bucket could never be admitted
+        estimated_tokens = int(min(estimated_tokens, self._tokens.capacity))
+        ticket = self._acquire(estimated_tokens, priority)
+
+        try:
+            result = call()
+        except openai.RateLimitError as e:
+            self._pause(retry_after_seconds(e) or self.DEFAULT_RATE_LIMIT_PAUSE, ticket.priority)
+            self._release(ticket, None, failed=True)
+            raise
+        except Exception:
+            self._release(ticket, None, failed=True)
+            raise
+
+        usage = getattr(result, "usage", None)
+        self._release(ticket, getattr(usage, "total_tokens", None), failed=False)
+        return result
+
+    def _acquire(self, estimated_tokens: int, priority: Priority) -> _Ticket:
+        budget = self.latency_budgets[priority]
+
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            self._counters[priority]["submitted"] += 1
+
+            if self._estimate_wait(priority, estimated_tokens) > budget:
+                self._counters[priority]["shed"] += 1
+                raise LLMOverloadedError(f"LLM queue over budget for {priority.name.lower()} traffic")
+
+            ticket = _Ticket(priority, estimated_tokens, now, now + budget)
+            heapq.heappush(self._queue, (priority, next(self._seq), ticket))
+            self._max_depth = max(self._max_depth, len(self._queue))
+
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+
+                wait = None
+                if self._queue[0][2] is ticket:
+                    requests_needed, tokens_needed = self._needed(priority, 1, ticket.tokens)
+                    wait = max(
+                        self._requests.time_until(requests_needed),
+                        self._tokens.time_until(tokens_needed),
+                        self._paused_until - now
+                    )
+                    if wait <= 0:
+                        heapq.heappop(self._queue)
+                        self._requests.consume(1)
+                        self._tokens.consume(ticket.tokens)
+                        self._in_flight += 1
+                        self._waits[priority].append(now - ticket.enqueued_at)
+                        # Let the next ticket re-check the buckets
+                        self._cond.notify_all()
+                        return ticket
+
+                if now >= ticket.deadline or (wait is not None and now + wait > ticket.deadline):
+                    self._queue = [entry for entry in self._queue if entry[2] is not ticket]
+                    heapq.heapify(self._queue)
+                    self._counters[priority]["shed"] += 1
+                    self._cond.notify_all()
+                    raise LLMOverloadedError(f"LLM call waited past its {budget}s budget")
+
+                self._cond.wait(timeout=wait if wait is not None else ticket.deadline - now)
+
+    def _release(self, ticket: _Ticket, actual_tokens: Optional[int], failed: bool) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            self._counters[ticket.priority]["failed" if failed else "completed"] += 1
+            if actual_tokens is not None and actual_tokens > ticket.tokens:
+                # OpenAI counts max_tokens against TPM up front, so over-estimates are
+                # never refunded; only charge when usage exceeded the estimate
+                self._refill(time.monotonic())
+                self._tokens.consume(actual_tokens - ticket.tokens)
+            self._cond.notify_all()
+
+    def _pause(self, seconds: float, priority: Priority) -> None:
+        """Back off after a 429: drain both buckets and hold admission for `seconds`"""
+        with self._cond:
+            now = time.monotonic()
+            self._counters[priority]["rate_limited"] += 1
+            self._requests.drain(now)
+            self._tokens.drain(now)
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._cond.notify_all()
+
+    def _refill(self, now: float) -> None:
+        self._requests.refill(now)
+        self._tokens.refill(now)
+
+    def _needed(self, priority: Priority, requests: float, tokens: float) -> Tuple[float, float]:
+        """Bucket levels required to admit a call, including the interactive reserve for BATCH"""
+        if priority == Priority.INTERACTIVE:
+            return requests, tokens
+        # Capped at capacity so a batch call can always eventually run
+        return (
+            min(self._requests.capacity, requests + self.batch_reserve * self._requests.capacity),
+            min(self._tokens.capacity, tokens + self.batch_reserve * self._tokens.capacity)
+        )
+
+    def _estimate_wait(self, priority: Priority, estimated_tokens: int) -> float:
+        """Expected wait for a new ticket given everything queued ahead of it"""
+        ahead = [entry[2] for entry in self._queue if entry[0] <= priority]
+        requests_needed = len(ahead) + 1
+        tokens_needed = sum(t.tokens for t in ahead) + estimated_tokens
+        if priority != Priority.INTERACTIVE:
+            requests_needed += self.batch_reserve * self._requests.capacity
+            tokens_needed += self.batch_reserve * self._tokens.capacity
+        return max(
+            self._requests.time_until(requests_needed),
+            self._tokens.time_until(tokens_needed),
+            self._paused_until - time.monotonic()
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot of queue depth, wait times and quota state"""
+        with self._cond:
+            self._refill(time.monotonic())
+            by_priority = {}
+            for p in Priority:
+                waits = sorted(self._waits[p])
+                by_priority[p.name.lower()] = {
+                    **self._counters[p],
+                    "queued": sum(1 for entry in self._queue if entry[0] == p),
+                    "latency_budget_s": self.latency_budgets[p],
+                    "wait_s": {
+                        "mean": sum(waits) / len(waits) if waits else 0.0,
+                        "p50": _percentile(waits, 0.50),
+                        "p95": _percentile(waits, 0.95),
+                        "max": waits[-1] if waits else 0.0,
+                    },
+                }
+
+            return {
+                "queue_depth": len(self._queue),
+                "max_queue_depth": self._max_depth,
+                "in_flight": self._in_flight,
+                "requests_available": round(self._requests.tokens, 2),
+                "tokens_available": round(self._tokens.tokens, 2),
+                "paused_for_s": round(max(0.0, self._paused_until - time.monotonic()), 2),
+                "priorities": by_priority,
+            }
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
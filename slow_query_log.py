@@ -0,0 +1,336 @@
+import json
+import random
+import sys
+import threading
+from collections import Counter, defaultdict
+from dataclasses import asdict, is_dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+# Elasticsearch query DSL leaf/compound clause types we track in query shapes
+CLAUSE_TYPES = {
+    "bool", "match", "match_phrase", "multi_match", "term", "terms", "range",
+    "nested", "match_all", "exists", "wildcard", "script_score", "knn"
+}
+# Order matters: BoolQueryBuilder adds clauses to the Lucene BooleanQuery as
+# must, must_not, should, filter, and profile children are paired with it
+BOOL_OCCURRENCES = ("must", "must_not", "should", "filter")
+
+
+class SlowQueryLog:
+    """
+    Sampling slow-query log for Elasticsearch searches.
+
+    Searches slower than `threshold_ms` are written to a JSONL file together with
+    the extracted SearchFeatures, the ES body, `took` and - for searches that were
+    sampled for profiling - the ES `profile` section. Profiling slows a search down,
+    so profiled entries are flagged and kept out of the per-shape `took` statistics.
+    """
+
+    def __init__(
+        self,
+        path: str = "slow_queries.jsonl",
+        threshold_ms: float = 500.0,
+        sample_rate: float = 1.0,
+        profile_rate: float = 0.0
+    ):
+        self.path = path
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.profile_rate = profile_rate
+        self._lock = threading.Lock()
+
+    def should_profile(self) -> bool:
+        """Whether the next search should be sent with `"profile": true`"""
+        return self.profile_rate > 0 and random.random() < self.profile_rate
+
+    def record(
+        self,
+        features: Any,
+        user_query: str,
+        es_query: Dict[str, Any],
+        response: Dict[str, Any],
+        elapsed_ms: float,
+        strategy: str,
+        profiled: bool = False
+    ) -> bool:
+        """Append an entry if the search was slow and sampled; returns whether it was written"""
+        # elasticsearch-py 8 returns an ObjectApiResponse wrapping the raw body
+        response = getattr(response, "body", response)
+        took = response.get("took", elapsed_ms)
+        if max(took, elapsed_ms) < self.threshold_ms or random.random() >= self.sample_rate:
+            return False
+
+        entry = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "strategy": strategy,
+            "profiled": profiled,
+            "user_query": user_query,
+            "took": took,
+            "elapsed_ms": round(elapsed_ms, 2),
+            "shape": query_shape(es_query),
+            "features": asdict(features) if is_dataclass(features) else features,
+            "query": _strip_vectors({k: v for k, v in es_query.items() if k != "profile"}),
+            "profile": response.get("profile"),
+        }
+        line = json.dumps(entry, default=str)
+
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"Error writing slow query log: {e}")
+            return False
+        return True
+
+
+def _strip_vectors(node: Any) -> Any:
+    """Copy of an ES body with embedding vectors replaced by a short placeholder"""
+    if isinstance(node, dict):
+        return {
+            k: f"<{len(v)} floats>" if k == "query_vector" and isinstance(v, list) else _strip_vectors(v)
+            for k, v in node.items()
+        }
+    if isinstance(node, list):
+        return [_strip_vectors(item) for item in node]
+    return node
+
+
+def _bucket(count: int) -> str:
+    """Bucket clause counts so near-identical shapes group together"""
+    if count <= 2:
+        return str(count)
+    if count <= 4:
+        return "3-4"
+    if count <= 8:
+        return "5-8"
+    return "9+"
+
+
+def _clause_path(path: str, clause: str) -> str:
+    return f"{path}.{clause}" if path else clause
+
+
+def _bool_children(path: str, name: str, body: Dict[str, Any]) -> List[Tuple[str, Any]]:
+    """(child path, clause) pairs of a bool, in ES BoolQueryBuilder order (must, must_not, should, filter)"""
+    # The root bool is implied, so its children read "should.match" rather than "bool.should.match"
+    prefix = name if path else ""
+    children = []
+    for occ in BOOL_OCCURRENCES:
+        clauses = body.get(occ, [])
+        for clause in clauses if isinstance(clauses, list) else [clauses]:
+            children.append((_clause_path(prefix, occ), clause))
+    return children
+
+
+def clause_counts(node: Any, path: str = "", counts: Optional[Counter] = None) -> Counter:
+    """
+    Count clauses by their full path in the query, e.g. {"should.nested.bool.must.term": 2,
+    "filter.bool.should.term": 1}, keeping filter context apart from scoring clauses.
+    """
+    if counts is None:
+        counts = Counter()
+
+    if isinstance(node, list):
+        for item in node:
+            clause_counts(item, path, counts)
+        return counts
+
+    if not isinstance(node, dict):
+        return counts
+
+    for key, value in node.items():
+        if key not in CLAUSE_TYPES:
+            continue
+        name = _clause_path(path, key)
+        counts[name] += 1
+        if key == "bool" and isinstance(value, dict):
+            for child_path, clause in _bool_children(path, name, value):
+                clause_counts(clause, child_path, counts)
+        elif isinstance(value, dict):
+            # nested / script_score wrap an inner query
+            clause_counts(value.get("query"), name, counts)
+
+    return counts
+
+
+def query_shape(es_query: Dict[str, Any]) -> str:
+    """Canonical shape string for an ES body, independent of the literal values"""
+    counts = clause_counts(es_query.get("query", {}))
+    return "|".join(f"{clause}x{_bucket(n)}" for clause, n in sorted(counts.items()))
+
+
+def _exclusive_nanos(node: Dict[str, Any]) -> int:
+    child_time = sum(child.get("time_in_nanos", 0) for child in node.get("children", []))
+    return max(0, node.get("time_in_nanos", 0) - child_time)
+
+
+def _profile_exclusive_times(node: Dict[str, Any], totals: Dict[str, int]) -> None:
+    """Accumulate per Lucene query type the time spent in the node itself, excluding children"""
+    totals[node.get("type", "unknown")] += _exclusive_nanos(node)
+    for child in node.get("children", []):
+        _profile_exclusive_times(child, totals)
+
+
+def _attribute_profile(node: Any, path: str, profile: Dict[str, Any], totals: Dict[str, int]) -> None:
+    """
+    Walk a DSL clause and its Lucene profile node together, charging time to clause paths.
+
+    Compound clauses are only descended into when the profile tree has the matching
+    structure; otherwise ES rewrote the clause and its whole inclusive time is charged
+    to the clause itself. Summed over all paths this equals the root query time.
+    """
+    if not isinstance(node, dict):
+        return
+    clauses = [(k, v) for k, v in node.items() if k in CLAUSE_TYPES]
+    if len(clauses) != 1:
+        return
+    key, value = clauses[0]
+    name = _clause_path(path, key)
+
+    # Boosted clauses show up wrapped in a BoostQuery
+    inner = profile
+    while inner.get("type") == "BoostQuery" and len(inner.get("children", [])) == 1:
+        inner = inner["children"][0]
+    wrapper_nanos = profile.get("time_in_nanos", 0) - inner.get("time_in_nanos", 0)
+    profile_children = inner.get("children", [])
+
+    if key == "bool" and isinstance(value, dict):
+        children = _bool_children(path, name, value)
+        if inner.get("type") == "BooleanQuery" and len(profile_children) == len(children):
+            totals[name] += wrapper_nanos + _exclusive_nanos(inner)
+            for (child_path, clause), child_profile in zip(children, profile_children):
+                _attribute_profile(clause, child_path, child_profile, totals)
+            return
+    elif isinstance(value, dict) and isinstance(value.get("query"), dict) and len(profile_children) == 1:
+        totals[name] += wrapper_nanos + _exclusive_nanos(inner)
+        _attribute_profile(value["query"], name, profile_children[0], totals)
+        return
+
+    totals[name] += profile.get("time_in_nanos", 0)
+
+
+def analyze_slow_queries(path: str, top: int = 10) -> Dict[str, Any]:
+    """
+    Group slow-query log entries by shape and rank clauses by cost.
+
+    Shape `took` statistics and clause frequency come only from unprofiled entries,
+    since profiling inflates latency and over-logs. Clause cost comes only from
+    profiled entries, by mapping the ES profile tree back onto clause paths, together
+    with exclusive Lucene time per query type.
+    """
+    shapes = defaultdict(lambda: {"count": 0, "profiled": 0, "total_took": 0, "max_took": 0, "example": None})
+    clause_frequency = defaultdict(lambda: {"entries": 0, "instances": 0})
+    clause_cost = defaultdict(lambda: {"entries": 0, "total_nanos": 0})
+    profile_nanos = defaultdict(int)
+    profiled = 0
+    entries = 0
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entries += 1
+
+            took = entry.get("took", 0)
+            dsl = entry.get("query", {}).get("query", {})
+            shape = shapes[entry.get("shape", "")]
+
+            if entry.get("profiled", bool(entry.get("profile"))):
+                shape["profiled"] += 1
+            else:
+                shape["count"] += 1
+                shape["total_took"] += took
+                if took >= shape["max_took"]:
+                    shape["max_took"] = took
+                    shape["example"] = entry.get("user_query")
+
+                for clause, n in clause_counts(dsl).items():
+                    clause_frequency[clause]["entries"] += 1
+                    clause_frequency[clause]["instances"] += n
+
+            if entry.get("profile"):
+                profiled += 1
+                entry_nanos = defaultdict(int)
+                for shard in entry["profile"].get("shards", []):
+                    for search in shard.get("searches", []):
+                        roots = search.get("query", [])
+                        if roots:
+                            _attribute_profile(dsl, "", roots[0], entry_nanos)
+                        for node in roots:
+                            _profile_exclusive_times(node, profile_nanos)
+                for clause, nanos in entry_nanos.items():
+                    clause_cost[clause]["entries"] += 1
+                    clause_cost[clause]["total_nanos"] += nanos
+
+    shape_ranking = sorted(
+        (
+            {"shape": s, **v, "mean_took": v["total_took"] / v["count"] if v["count"] else 0.0}
+            for s, v in shapes.items()
+        ),
+        key=lambda s: s["total_took"],
+        reverse=True
+    )
+    clause_ranking = sorted(
+        (
+            {"clause": c, "entries": v["entries"], "total_ms": v["total_nanos"] / 1e6,
+             "mean_ms": v["total_nanos"] / 1e6 / v["entries"]}
+            for c, v in clause_cost.items()
+        ),
+        key=lambda c: c["total_ms"],
+        reverse=True
+    )
+    frequency_ranking = sorted(
+        ({"clause": c, **v} for c, v in clause_frequency.items()),
+        key=lambda c: c["instances"],
+        reverse=True
+    )
+    profile_ranking = sorted(
+        ({"query_type": t, "exclusive_ms": n / 1e6} for t, n in profile_nanos.items()),
+        key=lambda p: p["exclusive_ms"],
+        reverse=True
+    )
+
+    return {
+        "entries": entries,
+        "profiled_entries": profiled,
+        "shapes": shape_ranking[:top],
+        "clauses": clause_ranking[:top],
+        "clause_frequency": frequency_ranking[:top],
+        "profile": profile_ranking[:top],
+    }
+
+
+def _print_report(report: Dict[str, Any]) -> None:
+    print(f"{report['entries']} slow queries ({report['profiled_entries']} profiled)\n")
+
+    print("Top shapes by total took (unprofiled entries):")
+    for s in report["shapes"]:
+        print(f"  {s['count']:>5}x (+{s['profiled']} profiled)  mean {s['mean_took']:>8.1f}ms  max {s['max_took']:>6}ms  {s['shape']}")
+        print(f"         e.g. {s['example']!r}")
+
+    if report["clauses"]:
+        print("\nClauses by profiled time:")
+        for c in report["clauses"]:
+            print(f"  {c['clause']:<40} {c['total_ms']:>10.2f}ms  mean {c['mean_ms']:>8.2f}ms  ({c['entries']} queries)")
+    else:
+        print("\nNo profiled entries - set SLOW_QUERY_PROFILE_RATE to rank clauses by cost")
+
+    print("\nClause frequency (unprofiled entries):")
+    for c in report["clause_frequency"]:
+        print(f"  {c['clause']:<40} {c['instances']:>6} clauses in {c['entries']} queries")
+
+    if report["profile"]:
+        print("\nLucene query types by exclusive profiled time:")
+        for p in report["profile"]:
+            print(f"  {p['query_type']:<40} {p['exclusive_ms']:>10.2f}ms")
+
+
+if __name__ == "__main__":
+    # python slow_query_log.py [slow_queries.jsonl]
+    _print_report(analyze_slow_queries(sys.argv[1] if len(sys.argv) > 1 else "slow_queries.jsonl"))